@@ -32,6 +32,7 @@ from trac.web.chrome import (
 )
 from trac.web.api import IRequestHandler, IRequestFilter
 
+from trac.wiki.api import WikiSystem
 from trac.wiki.macros import WikiMacroBase
 from trac.wiki.model import WikiPage
 from trac.wiki.formatter import format_to_html
@@ -41,6 +42,39 @@ from trac.util.html import Markup, tag
 PLUGIN_NAME = "TracChecklist"
 PLUGIN_VERSION = 1
 
+# max number of parsed checklist templates kept in memory
+_TEMPLATE_CACHE_SIZE = 100
+
+# checklist steps in formatted html: "[x] something to do ... <br />"
+_STEP_RE = re.compile(r"(?=\[x])(.*?)(?<=<br \/>)")
+
+# html fragments of a checklist step, joined around the per-step values:
+# open + name + mid + status + tail + label + label close [+ code] + close
+_BOX_OPEN = '<div class="container"><label><input type="checkbox" name="'
+_CODE_BOX_OPEN = (
+    '<div class="container collapsible"><label><input type="checkbox" name="'
+)
+_BOX_MID = '" value="done" '
+_BOX_TAIL = ' /><span class="checkmark"></span>'
+_BOX_LABEL_CLOSE = "</label>"
+_BOX_CLOSE = "</div>"
+
+# checkbox names of the first steps (step_1, step_2, ...), built once
+_STEP_NAMES = ["step_%d" % idx for idx in range(1, 257)]
+
+# invisible characters stripped from step labels (zero width space / BOM);
+# zero width (non-)joiners are kept, they matter in emoji and some scripts
+_ZW_TRANS = str.maketrans("", "", "\u200b\ufeff")
+
+# checklist steps in template wiki text, each optionally followed by a
+# code block ({{{ ... }}}) before the next step: "[x] something to do"
+_STEPS_RE = re.compile(
+    r"^[ \t]*(?P<step>\[x\][^\n]*)"
+    r"(?:\n(?:(?![ \t]*(?:\[x\]|\{\{\{))[^\n]*\n)*"
+    r"[ \t]*\{\{\{[^\n]*(?P<code>.*?)(?:\r?\n[ \t]*\}\}\}|\r?\n?\Z))?",
+    re.MULTILINE | re.DOTALL,
+)
+
 
 class ChecklistMacro(WikiMacroBase):
     """Insert checklist instance sourced from wiki page template."""
@@ -55,8 +89,24 @@ class ChecklistMacro(WikiMacroBase):
         doc="root wiki page for checklist templates",
     )
 
+    # checklist form footer, values are escaped by Markup's % operator
+    _FOOT_HTML = Markup(
+        '<input type="hidden" name="__backpath__" value="%s"/>'
+        '<input type="hidden" name="__FORM_TOKEN" value="%s"/>'
+        '<input type="hidden" name="realm" value="%s"/>'
+        '<input type="hidden" name="resource" value="%s"/>'
+        '<input type="hidden" name="checklist" value="%s"/>'
+    )
+    _SUBMIT_HTML = Markup(
+        '<input type="submit" class="button" value="Save Checklist"/>'
+    )
+
     implements(ITemplateProvider)
 
+    def __init__(self):
+        # parsed templates: (name, version) -> (wiki, steps, any_code)
+        self._template_cache = {}
+
     def parse_macro(self):
         """Not used (included to satisfy abstract class requirement)"""
         pass
@@ -69,170 +119,183 @@ class ChecklistMacro(WikiMacroBase):
         """directories where html templates are located."""
         return [resource_filename(__name__, "htdocs")]
 
-    def process_steps_with_code(self, html, status, steps_with_code):
+    def process_steps_with_code(self, html, status, steps_with_code, any_code=True):
         """Process HTML with knowledge of which steps have code blocks"""
         
-        # Find all steps in HTML
-        regex = r"(?=\[x])(.*?)(?<=<br \/>)"
-        html_steps = re.findall(regex, html)
+        # Find all steps in HTML (in document order); the match list is
+        # only needed to bound code block searches, so without any code
+        # blocks the matches are consumed lazily in a single scan
+        step_matches = None
+        if any_code:
+            step_matches = list(_STEP_RE.finditer(html))
+            html_steps = step_matches
+        else:
+            html_steps = _STEP_RE.finditer(html)
         
         self.log.debug("Processing HTML steps with code knowledge")
         
-        # Process each step
+        # Process each step, copying html forward from a single cursor
+        out = []
+        pos = 0
         box_idx = 0
-        for step, step_info in zip(html_steps, steps_with_code):
+        for match, step_info in zip(html_steps, steps_with_code):
             box_idx = box_idx + 1
-            box_name = "step_%d" % box_idx
-            box_label = step[4:]  # Remove [x]
-            box_label = box_label.replace(u'\u200b', "")
+            if box_idx <= len(_STEP_NAMES):
+                box_name = _STEP_NAMES[box_idx - 1]
+            else:
+                box_name = "step_%d" % box_idx
+            box_label = match.group()[4:]  # Remove [x]
+            box_label = box_label.translate(_ZW_TRANS)
             
             box_status = ""
-            if box_name in status.keys():
+            if box_name in status:
                 box_status = "checked"
             
+            out.append(html[pos:match.start()])
+            pos = match.end()
+
             if step_info['has_code']:
-                # Find the next pre tag in HTML after this step
-                step_end = html.find(step) + len(step)
-                pre_start = html[step_end:].find('<pre class="wiki">')
-                if pre_start != -1:
-                    pre_end = html[step_end:].find('</pre>') + 6  # include </pre>
-                    code_block = html[step_end:][pre_start:pre_start + pre_end]
-                    
-                    box_html = Markup(
-                        (
-                            '<div class="container collapsible">'
-                            '<label>'
-                            '<input type="checkbox" name="{}" value="done" {} />'
-                            '<span class="checkmark"></span>'
-                            '{}'
-                            '</label>'
-                            '{}'
-                            '</div>'
-                        ).format(box_name, box_status, box_label, code_block)
-                    )
-                    
-                    # Remove the original pre tag since we moved it
-                    html = html.replace(code_block, '', 1)
+                # Find the next pre tag in HTML after this step (but before
+                # the next step, so the cursor never skips over a step)
+                if box_idx < len(step_matches):
+                    limit = step_matches[box_idx].start()
                 else:
-                    # Fallback if pre tag not found
-                    box_html = Markup(
-                        (
-                            '<div class="container">'
-                            '<label>'
-                            '<input type="checkbox" name="{}" value="done" {} />'
-                            '<span class="checkmark"></span>'
-                            '{}'
-                            '</label>'
-                            '</div>'
-                        ).format(box_name, box_status, box_label)
-                    )
-            else:
-                # Regular checkbox for items without code blocks
-                box_html = Markup(
-                    (
-                        '<div class="container">'
-                        '<label>'
-                        '<input type="checkbox" name="{}" value="done" {} />'
-                        '<span class="checkmark"></span>'
-                        '{}'
-                        '</label>'
-                        '</div>'
-                    ).format(box_name, box_status, box_label)
+                    limit = len(html)
+                pre_start = html.find('<pre class="wiki">', pos, limit)
+                pre_end = -1
+                if pre_start != -1:
+                    pre_end = html.find('</pre>', pre_start, limit)
+                if pre_end != -1:
+                    pre_end = pre_end + 6  # include </pre>
+
+                    # Move the original pre tag into the collapsible box
+                    out.extend((
+                        _CODE_BOX_OPEN, box_name, _BOX_MID, box_status,
+                        _BOX_TAIL, box_label, _BOX_LABEL_CLOSE,
+                        html[pre_start:pre_end], _BOX_CLOSE,
+                        html[pos:pre_start],
+                    ))
+                    pos = pre_end
+                    continue
+
+            # Regular checkbox for items without code blocks (or if the
+            # pre tag was not found)
+            out.extend((
+                _BOX_OPEN, box_name, _BOX_MID, box_status,
+                _BOX_TAIL, box_label, _BOX_LABEL_CLOSE, _BOX_CLOSE,
+            ))
+
+        out.append(html[pos:])
+        return Markup("".join(out))
+
+    def parse_template(self, page):
+        """Parse checklist template into its steps
+
+        Args:
+            page (obj): checklist template wiki page
+
+        Returns:
+            wiki             (STR): template wiki text without header
+            steps_with_code (LIST): step info dicts (step, has_code, code)
+            any_code        (BOOL): true if any step has a code block
+        """
+        # strip header (if exists)
+        # header is separated with horizontal line: ----
+        wiki = page.text
+        self.log.debug("Original wiki text: %s", repr(wiki))
+        # (plain substring scan; skip longer runs of dashes)
+        line = wiki.find("----")
+        while line != -1:
+            end = line + 4
+            if (line == 0 or wiki[line - 1] != "-") and wiki[end : end + 1] != "-":
+                wiki = wiki[end + 1 :]
+                break
+            line = wiki.find("----", end)
+
+        # First identify steps and their code blocks in wiki text
+        steps_with_code = []
+        # (the code group starts with the newline ending the {{{ line; page
+        # text saved from the browser uses \r\n line endings)
+        for match in _STEPS_RE.finditer(wiki):
+            code = match.group("code")
+            steps_with_code.append({
+                'step': match.group("step").strip(),
+                'has_code': bool(code),
+                'code': code[1:].replace("\r\n", "\n") if code else None
+            })
+
+        self.log.debug("Parsed steps: %s", repr(steps_with_code))
+
+        any_code = any(step_info['has_code'] for step_info in steps_with_code)
+
+        return wiki, steps_with_code, any_code
+
+    def get_statuses(self, req, resource):
+        """Load the status of all checklist instances of a resource
+
+        All checklists in e.g. a ticket description are fetched with one
+        query, and kept with the request for the remaining macro calls.
+
+        Args:
+            req      (obj): web request that called the page with the macro
+            resource (obj): resource (ticket, wiki page, ...) with the macro
+
+        Returns:
+            statuses (DICT): checklist name -> checkbox status dictionary
+        """
+        cache = req.environ.setdefault("checklist.statuses", {})
+        key = (resource.realm, resource.id)
+        if key not in cache:
+            statuses = {}
+            with self.env.db_query as db_query:
+                query = (
+                    "SELECT checklist, status FROM checklist WHERE "
+                    + "realm = %s AND resource  = %s "
                 )
-            
-            html = html.replace(step, box_html)
-        
-        return html
+                param = [resource.realm, resource.id]
+
+                cursor = db_query.cursor()
+                cursor.execute(query, param)
+                for row in cursor.fetchall():
+                    # nothing checked yet: skip the JSON parse
+                    raw = row[1]
+                    statuses[row[0]] = json.loads(raw) if raw and raw != "{}" else {}
+            cache[key] = statuses
+
+        return cache[key]
 
     def expand_macro(self, formatter, name, content):
         """Expand the macro into the requested checklist instance."""
         # get checklist instance states (JSON encoded checkbox status)
-        box_status = {}
-        with self.env.db_query as db_query:
-            query = (
-                "SELECT status FROM checklist WHERE "
-                + "realm = %s AND resource  = %s AND checklist = %s "
-            )
-            param = [formatter.resource.realm, formatter.resource.id, content]
-
-            cursor = db_query.cursor()
-            cursor.execute(query, param)
-            row = cursor.fetchone()
-            if row:
-                box_status = json.loads(row[0])
+        statuses = self.get_statuses(formatter.req, formatter.resource)
+        box_status = statuses.get(content, {})
 
         # get checklist template (wiki page)
-        cname = str(self._root) + "/" + content
-        cname = cname.replace("//", "/")
+        cname = str(self._root).rstrip("/") + "/" + content.lstrip("/")
         page = WikiPage(self.env, cname)
         if not page.exists:
             err_msg = "CHECKLIST ERROR: \n template '" + cname + "' does not exist."
             return err_msg
 
-        # strip header (if exists), convert to html, insert checkboxes
-        # header is separated with horizontal line: ----
-        wiki = page.text
-        self.log.debug("Original wiki text: %s", repr(wiki))
-        line = re.search("(?<!-)----(?!-)", wiki)
-        if line:
-            wiki = wiki[line.end() + 1 :]
-
-        # First identify steps and their code blocks in wiki text
-        steps_with_code = []
-        lines = wiki.splitlines()
-        i = 0
-        
-        while i < len(lines):
-            line = lines[i].strip()
-            
-            if not line:
-                i += 1
-                continue
-                
-            if line.startswith('[x]'):
-                # We found a step, look ahead for code block
-                current_step = line
-                code_content = []
-                i += 1
-                
-                # Look for a code block immediately following this step
-                while i < len(lines):
-                    next_line = lines[i].strip()
-                    if next_line.startswith('{{{'):
-                        # Found a code block, collect until }}}
-                        i += 1  # Skip the {{{ line
-                        while i < len(lines) and not lines[i].strip().startswith('}}}'):
-                            code_content.append(lines[i])
-                            i += 1
-                        i += 1  # Skip the }}} line
-                        break
-                    elif next_line.startswith('[x]'):
-                        # Found next step, don't increment i so we process it in next iteration
-                        break
-                    elif next_line:
-                        # Some other content
-                        i += 1
-                    else:
-                        i += 1
-                
-                # Save the step
-                steps_with_code.append({
-                    'step': current_step,
-                    'has_code': len(code_content) > 0,
-                    'code': '\n'.join(code_content) if code_content else None
-                })
-                continue
-                
-            i += 1
-        
-        self.log.debug("Parsed steps: %s", repr(steps_with_code))
-        
-        # Convert to HTML
+        # parsed steps only change with the page revision, so reuse them
+        key = (cname, page.version)
+        parsed = self._template_cache.get(key)
+        if parsed is None:
+            parsed = self.parse_template(page)
+            if len(self._template_cache) >= _TEMPLATE_CACHE_SIZE:
+                self._template_cache.clear()
+            self._template_cache[key] = parsed
+        wiki, steps_with_code, any_code = parsed
+
+        # Convert to HTML (depends on the calling resource and the viewer's
+        # permissions, e.g. for attachment links, so it is never cached)
         html = format_to_html(self.env, formatter.context, wiki)
         self.log.debug("HTML after format_to_html: %s", repr(html))
 
         # Process the HTML with our parsed knowledge
-        processed_html = self.process_steps_with_code(html, box_status, steps_with_code)
+        processed_html = self.process_steps_with_code(
+            html, box_status, steps_with_code, any_code
+        )
         
         # Create the form
         form = tag.form(
@@ -251,13 +314,9 @@ class ChecklistMacro(WikiMacroBase):
         realm = str(formatter.resource.realm)
         resource = str(formatter.resource.id)
         checklist = str(content)
-        foot = tag(
-            tag.input(type="hidden", name="__backpath__", value=backpath),
-            tag.input(type="hidden", name="__FORM_TOKEN", value=form_token),
-            tag.input(type="hidden", name="realm", value=realm),
-            tag.input(type="hidden", name="resource", value=resource),
-            tag.input(type="hidden", name="checklist", value=checklist),
-            tag.input(type="submit", class_="button", value="Save Checklist"),
+        foot = (
+            self._FOOT_HTML % (backpath, form_token, realm, resource, checklist)
+            + self._SUBMIT_HTML
         )
 
         # Add stylesheets and scripts
@@ -283,27 +342,52 @@ class ChecklistUpdate(Component):
         match = req.path_info.endswith("checklist/update")
         return match
 
+    def save_status(self, realm, resource, checklist, status):
+        """Save checklist instance state (update in place, insert on first save)
+
+        Row existence is checked with a SELECT, as rowcount only counts
+        changed rows on MySQL. If a concurrent first save inserted the row
+        in the meantime, the INSERT fails and the row is updated instead.
+
+        Args:
+            realm     (STR): realm of the resource with the checklist
+            resource  (STR): id of the resource with the checklist
+            checklist (STR): name of checklist template
+            status    (STR): JSON encoded checkbox status
+        """
+        where = "realm = %s AND resource = %s AND checklist = %s"
+        param = [realm, resource, checklist]
+        update = "UPDATE checklist SET status = %s WHERE " + where
+        try:
+            with self.env.db_transaction as db:
+                cursor = db.cursor()
+                cursor.execute(update, [status] + param)
+                cursor.execute("SELECT 1 FROM checklist WHERE " + where, param)
+                if not cursor.fetchall():
+                    query = (
+                        "INSERT INTO checklist (realm,resource,checklist,status) "
+                        + "VALUES (%s, %s, %s, %s)"
+                    )
+                    cursor.execute(query, param + [status])
+        except self.env.db_exc.IntegrityError:
+            # (failed transaction is rolled back, retry in a new one)
+            self.env.db_transaction(update, [status] + param)
+
     def process_request(self, req):
         """saves updated checklist state to the database."""
 
         try:
             # get form data and new status as JSON string
-            args = dict(req.args)
+            args = req.args
             backpath = args["__backpath__"]
             realm = args["realm"]
             resource = args["resource"]
             checklist = args["checklist"]
-            steps = {k: v for k, v in args.iteritems() if k.startswith("step")}
+            steps = {k: v for k, v in args.items() if k[:4] == "step"}
             status = json.dumps(steps)
 
             # save to db
-            query = (
-                "REPLACE INTO checklist (realm,resource,checklist,status) "
-                + "VALUES (%s, %s, %s, %s)"
-            )
-            param = [realm, resource, checklist, status]
-
-            self.env.db_transaction(query, param)
+            self.save_status(realm, resource, checklist, status)
             form_buffer = "OK"
 
             if backpath is not None:
@@ -367,24 +451,10 @@ class ChecklistInsert(Component):
         self.log.debug("TracChecklist #### template: %s", template)
         if template in ["ticket.html"]:
             # list of available checklist templates (pages) under root wiki page
-            templates = []
-            root = Option(
-                "checklist",
-                "template_root",
-                default="TracChecklist",
-                doc="wiki page root for checklist templates",
-            )
-            root = self.config.get("checklist", "template_root")
-            query = "SELECT name FROM wiki WHERE version = 1 AND name LIKE %s"
-            param = ["%" + root + "%"]
-
-            with self.env.db_query as db_query:
-                cursor = db_query.cursor()
-                cursor.execute(query, param)
-                # self.log.debug(cursor._executed)
-                for row in cursor.fetchall():
-                    if row[0] != root:
-                        templates.append(row[0].replace(root + "/", ""))
+            # (read from Trac's own cached set of wiki page names)
+            prefix = self.config.get("checklist", "template_root") + "/"
+            pages = WikiSystem(self.env).get_pages(prefix)
+            templates = sorted(name[len(prefix) :] for name in pages)
 
             # add new ticket components (CSS, jquery, template list)
             add_stylesheet(req, "checklist/menu.css")